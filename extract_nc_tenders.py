@@ -2,14 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import os
+import codecs
 import re
 import time
-import hashlib
+import random
+import threading
+import multiprocessing
+from functools import lru_cache
+from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from typing import Optional, List, Dict
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlsplit, urlunsplit
 
+import orjson
 import requests
-from bs4 import BeautifulSoup
+import xxhash
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.html
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
 from dateutil import parser as dateparser
 from tqdm import tqdm
 from supabase import create_client, Client
@@ -36,12 +48,61 @@ HEADERS = {
 
 MAX_DETAIL_PER_SITE = 200
 DELAY_BETWEEN_REQUESTS = 1.2
+MAX_CONCURRENT_PER_HOST = 4
+# écart minimal entre deux débuts de requête sur un même hôte (≈ MAX_CONCURRENT_PER_HOST requêtes par DELAY)
+HOST_MIN_INTERVAL = DELAY_BETWEEN_REQUESTS / MAX_CONCURRENT_PER_HOST
+UPSERT_BATCH_SIZE = 50
+MAX_RESPONSE_BYTES = 4 * 1024 * 1024
+RECHECK_RATIO = 0.1  # part des fiches déjà connues re-téléchargées à chaque run
 
 LINK_KEYWORDS = [
     "appel", "offre", "march", "consult", "avis", "soumission", "aop", "aops",
     "notice", "detail", "fiche", "consultation"
 ]
 
+# =============== PATTERNS ===============
+
+_H1_XP = etree.XPath("(//h1)[1]")
+_OG_TITLE_XP = etree.XPath("//meta[@property='og:title']/@content")
+_TITLE_XP = etree.XPath("(//title)[1]")
+_BLOCKS_XP = etree.XPath("//p | //div")
+
+_CHARSET_RE = re.compile(r"charset=[\"']?([\w\-]+)", re.IGNORECASE)
+
+_LINK_KW_RE = re.compile("|".join(map(re.escape, LINK_KEYWORDS)), re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+_DATE_RE = re.compile(
+    r"\b(?:\d{1,2}[\/\-\.\s]\d{1,2}[\/\-\.\s]\d{2,4}|\d{4}[\/\-]\d{1,2}[\/\-]\d{1,2}|\d{1,2}\s+[A-Za-zéûôàâîïùç]+\.?\s+\d{4})\b",
+    re.IGNORECASE
+)
+_DATE_LIMIT_RE = re.compile(
+    r"(date limite|clôture|date de dépôt|délais)[^\n\r]{0,120}(\d{1,2}[\/\-\.\s]\d{1,2}[\/\-\.\s]\d{2,4}|\d{1,2}\s+[A-Za-zéûôàâîïùç]+\.?\s+\d{4}|\d{4}-\d{2}-\d{2})",
+    re.IGNORECASE
+)
+_ORG_RES = [re.compile(p, re.IGNORECASE) for p in (
+    r"Organisme[:\s\-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})",
+    r"Ma[iî]tre d['’ ]ouvrage[:\s\-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})",
+    r"Collectivit[eé][: \-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})",
+    r"Pouvoir adjudicateur[:\s\-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})",
+)]
+_FR_DATE_RE = re.compile(r"(\d{1,2})\s+([^\W\d_]+)\.?\s+(\d{4})")
+_DATE_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%d.%m.%Y", "%Y/%m/%d")
+_FR_MONTHS = {
+    "janvier": 1, "janv": 1,
+    "février": 2, "fevrier": 2, "févr": 2, "fevr": 2, "fév": 2, "fev": 2,
+    "mars": 3,
+    "avril": 4, "avr": 4,
+    "mai": 5,
+    "juin": 6,
+    "juillet": 7, "juil": 7,
+    "août": 8, "aout": 8,
+    "septembre": 9, "sept": 9, "sep": 9,
+    "octobre": 10, "oct": 10,
+    "novembre": 11, "nov": 11,
+    "décembre": 12, "decembre": 12, "déc": 12, "dec": 12,
+}
+_REF_RE = re.compile(r"(Réf(?:érence)?|Ref\.?|N°|No)\s*[:\-\s]{0,5}([A-Z0-9\-/\.]{3,60})", re.IGNORECASE)
+
 # =============== SUPABASE ===============
 
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
@@ -52,12 +113,24 @@ def get_supabase() -> Client:
         raise RuntimeError("SUPABASE_URL et SUPABASE_SERVICE_KEY doivent être définis.")
     return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
+def get_rest_session() -> requests.Session:
+    # accès PostgREST direct pour les upserts en lot : corps sérialisé par orjson, pas de relecture des lignes
+    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+        raise RuntimeError("SUPABASE_URL et SUPABASE_SERVICE_KEY doivent être définis.")
+    rest = requests.Session()
+    rest.headers.update({
+        "apikey": SUPABASE_SERVICE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    })
+    rest.mount("https://", HTTPAdapter(pool_maxsize=len(START_SOURCES)))
+    return rest
+
 def stable_hash(*parts: Optional[str]) -> str:
-    h = hashlib.sha256()
-    for p in parts:
-        h.update((p or "").strip().encode("utf-8", errors="ignore"))
-        h.update(b"|")
-    return h.hexdigest()
+    # empreinte de détection de changement, pas un usage cryptographique
+    payload = "".join((p or "").strip() + "|" for p in parts).encode("utf-8", errors="ignore")
+    return xxhash.xxh3_128_hexdigest(payload)
 
 def upsert_url_source(sb: Client, nom: str, url: str) -> str:
     res = sb.table("urls_a_checker").upsert(
@@ -66,8 +139,24 @@ def upsert_url_source(sb: Client, nom: str, url: str) -> str:
     ).select("id").execute()
     return res.data[0]["id"]
 
-def upsert_appel(
-    sb: Client,
+def fetch_known_appels(
+    sb: Client, url_source_id: str, detail_urls: List[str], chunk_size: int = 50
+) -> Dict[str, Dict[str, Optional[str]]]:
+    # etag / last_modified : colonnes ajoutées par supabase/migrations/20261015000000_appels_offres_validators.sql
+    # seules les fiches candidates de ce run sont chargées, par lots (taille de l'URL de requête PostgREST)
+    known = {}
+    for i in range(0, len(detail_urls), chunk_size):
+        res = sb.table("appels_offres").select(
+            "detail_url, titre, organisme, reference, date_publication, date_limite, "
+            "statut, extrait, content_hash, etag, last_modified"
+        ).eq(
+            "url_source_id", url_source_id
+        ).in_("detail_url", detail_urls[i:i + chunk_size]).execute()
+        for row in res.data:
+            known[row["detail_url"]] = row
+    return known
+
+def build_appel(
     url_source_id: str,
     detail_url: str,
     titre: str,
@@ -77,9 +166,11 @@ def upsert_appel(
     date_limite: Optional[str],
     statut: str,
     extrait: Optional[str],
-) -> str:
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+) -> Dict[str, Optional[str]]:
     chash = stable_hash(titre, organisme, detail_url, date_publication, date_limite, extrait)
-    rec = {
+    return {
         "url_source_id": url_source_id,
         "detail_url": detail_url,
         "titre": titre or "(Sans titre)",
@@ -90,186 +181,402 @@ def upsert_appel(
         "statut": statut,
         "extrait": extrait,
         "content_hash": chash,
+        "etag": etag,
+        "last_modified": last_modified,
     }
-    res = sb.table("appels_offres").upsert(rec, on_conflict="detail_url").select("id").execute()
-    return res.data[0]["id"]
+
+def upsert_appels(rest: requests.Session, records: List[Dict[str, Optional[str]]]) -> None:
+    url = f"{SUPABASE_URL}/rest/v1/appels_offres?on_conflict=detail_url"
+    for i in range(0, len(records), UPSERT_BATCH_SIZE):
+        batch = records[i:i + UPSERT_BATCH_SIZE]
+        try:
+            rest.post(url, data=orjson.dumps(batch), timeout=60).raise_for_status()
+        except Exception as e:
+            print(f"[ERROR] upsert de {len(batch)} fiches -> {e}")
 
 # =============== HTTP helpers ===============
 
-def safe_get(session: requests.Session, url: str, retries: int = 2, timeout: int = 25) -> Optional[requests.Response]:
-    for attempt in range(retries + 1):
-        try:
-            r = session.get(url, headers=HEADERS, timeout=timeout)
-            if r.status_code == 200:
+NOT_MODIFIED = object()
+
+_host_next_slot: Dict[str, float] = {}
+_host_lock = threading.Lock()
+
+def wait_for_host(url: str) -> None:
+    # réserve le prochain créneau libre de l'hôte ; on ne dort que si l'hôte a été sollicité récemment
+    host = urlsplit(url).netloc
+    with _host_lock:
+        now = time.monotonic()
+        slot = max(now, _host_next_slot.get(host, 0.0))
+        _host_next_slot[host] = slot + HOST_MIN_INTERVAL
+    if slot > now:
+        time.sleep(slot - now)
+
+def make_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    # pool par hôte dimensionné pour les fetchs concurrents ; les retries sont gérés par urllib3
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def is_pdf_url(url: str) -> bool:
+    return urlsplit(url).path.lower().endswith(".pdf")
+
+def safe_get(session: requests.Session, url: str, timeout: int = 25, headers: Optional[Dict[str, str]] = None):
+    # renvoie la Response (200), NOT_MODIFIED (304 sur requête conditionnelle) ou None
+    wait_for_host(url)
+    try:
+        r = session.get(url, timeout=timeout, headers=headers, stream=True)
+        with r:
+            if r.status_code == 304:
+                return NOT_MODIFIED
+            if r.status_code != 200:
+                return None
+            # les PDF sont traités comme opaques par parse_detail : inutile d'en lire le corps
+            # (souvent servis en application/octet-stream : on regarde aussi l'URL et la signature %PDF)
+            if "application/pdf" in (r.headers.get("Content-Type") or "").lower() or is_pdf_url(url):
+                r._content = b""
                 return r
-        except Exception:
-            pass
-        time.sleep(1 + attempt)
+            chunks, size = [], 0
+            for chunk in r.iter_content(chunk_size=65536):
+                if not chunks and chunk.startswith(b"%PDF"):
+                    r._content = chunk
+                    return r
+                size += len(chunk)
+                if size > MAX_RESPONSE_BYTES:
+                    print(f"[WARN] réponse > {MAX_RESPONSE_BYTES} octets ignorée: {url}")
+                    return None
+                chunks.append(chunk)
+            # corps déjà lu : r.content / r.text restent utilisables après fermeture
+            r._content = b"".join(chunks)
+            return r
+    except Exception:
+        pass
     return None
 
 def clean_text(s: Optional[str]) -> str:
     if not s:
         return ""
-    return re.sub(r"\s+", " ", s).strip()
+    return _WHITESPACE_RE.sub(" ", s).strip()
 
 def likely_offer_link(href: str, text: str) -> bool:
-    l = (href or "") + " " + (text or "")
-    l = l.lower()
-    return any(k in l for k in LINK_KEYWORDS)
+    return bool(_LINK_KW_RE.search(href or "")) or bool(_LINK_KW_RE.search(text or ""))
 
 def find_candidate_links(session: requests.Session, listing_url: str) -> List[str]:
     r = safe_get(session, listing_url)
     if not r:
         print(f"[WARN] échec listing: {listing_url}")
         return []
-    soup = BeautifulSoup(r.text, "html.parser")
-    anchors = soup.find_all("a", href=True)
+    # lexbor décode toujours des octets en UTF-8 : on lui passe le texte décodé avec le bon charset
+    encoding = sniff_encoding(r.content, r.headers.get("Content-Type") or "") or "latin-1"
+    tree = LexborHTMLParser(r.content.decode(encoding, errors="replace"))
     base = listing_url
+    base_scheme = urlsplit(base).scheme + ":"
     candidates, seen = [], set()
-    for a in anchors:
-        href = a.get("href", "").strip()
-        text = a.get_text(" ", strip=True)
-        abs_url = urljoin(base, href)
-        if not abs_url.startswith(("http://", "https://")):
+    for a in tree.css("a[href]"):
+        href = (a.attributes.get("href") or "").strip()
+        # rejet avant urljoin, coûteux en pur Python ; "" et "#..." renvoient vers la page de listing elle-même
+        if not href or href.startswith(("#", "mailto:", "tel:", "javascript:")):
             continue
-        if abs_url.startswith(("mailto:", "tel:")):
+        if not href.startswith(("http://", "https://")):
+            abs_url = urljoin(base, href)
+        elif href.startswith(base_scheme):
+            # même résultat qu'urljoin ("?" et "#" vides supprimés) sans re-parser la base à chaque lien,
+            # pour que detail_url reste identique aux fiches déjà stockées
+            abs_url = urlunsplit(urlsplit(href))
+        else:
+            abs_url = href  # urljoin renvoie tel quel une URL d'un autre schéma
+        if not abs_url.startswith(("http://", "https://")) or abs_url in seen:
             continue
-        parsed = urlparse(abs_url)
-        if likely_offer_link(abs_url, text) or any(p in parsed.path.lower() for p in ("detail", "avis", "consult", "offre", "notice", "fiche")):
-            if abs_url not in seen:
-                seen.add(abs_url)
-                candidates.append(abs_url)
-        elif abs_url.lower().endswith(".pdf") and likely_offer_link(abs_url, text):
-            if abs_url not in seen:
-                seen.add(abs_url)
-                candidates.append(abs_url)
+        # les mots-clés de chemin (detail, avis, consult, offre, notice, fiche) sont déjà dans LINK_KEYWORDS
+        if likely_offer_link(abs_url, a.text(separator=" ", strip=True)):
+            seen.add(abs_url)
+            candidates.append(abs_url)
     return candidates[:MAX_DETAIL_PER_SITE]
 
-def parse_dates_from_text(text: str):
-    patt = re.findall(
-        r"\b(?:\d{1,2}[\/\-\.\s]\d{1,2}[\/\-\.\s]\d{2,4}|\d{4}[\/\-]\d{1,2}[\/\-]\d{1,2}|\d{1,2}\s+[A-Za-zéûôàâîïùç]+\.?\s+\d{4})\b",
-        text, flags=re.IGNORECASE
-    )
-    parsed = []
-    for d in patt:
+def _fast_parse(s: str) -> Optional[str]:
+    for fmt in _DATE_FORMATS:
         try:
-            dt = dateparser.parse(d, dayfirst=True, fuzzy=True)
-            parsed.append(dt.date().isoformat())
-        except Exception:
+            return datetime.strptime(s, fmt).date().isoformat()
+        except ValueError:
             pass
+    m = _FR_DATE_RE.fullmatch(s)
+    if m:
+        month = _FR_MONTHS.get(m.group(2).lower())
+        if month:
+            try:
+                return date(int(m.group(3)), month, int(m.group(1))).isoformat()
+            except ValueError:
+                return None
+    return None
+
+@lru_cache(maxsize=8192)
+def parse_date(s: str) -> Optional[str]:
+    # formats courants en accès direct ; dateutil (lent, fuzzy) seulement en dernier recours.
+    # mémoïsé : les mêmes dates reviennent d'une fiche à l'autre (un cache par process de parsing)
+    s = s.strip()
+    iso = _fast_parse(s)
+    if iso:
+        return iso
+    try:
+        return dateparser.parse(s, dayfirst=True, fuzzy=True).date().isoformat()
+    except Exception:
+        return None
+
+def parse_dates_from_text(text: str):
+    parsed = [iso for iso in map(parse_date, _DATE_RE.findall(text)) if iso]
     if parsed:
         parsed.sort()
         pub = parsed[0]
         lim = parsed[-1] if len(parsed) > 1 else None
         return pub, lim
-    m = re.search(
-        r"(date limite|clôture|date de dépôt|délais)[^\n\r]{0,120}(\d{1,2}[\/\-\.\s]\d{1,2}[\/\-\.\s]\d{2,4}|\d{1,2}\s+[A-Za-zéûôàâîïùç]+\.?\s+\d{4}|\d{4}-\d{2}-\d{2})",
-        text, flags=re.IGNORECASE
-    )
+    m = _DATE_LIMIT_RE.search(text)
     if m:
-        try:
-            dt = dateparser.parse(m.group(2), dayfirst=True, fuzzy=True)
-            return None, dt.date().isoformat()
-        except Exception:
-            pass
+        lim = parse_date(m.group(2))
+        if lim:
+            return None, lim
     return None, None
 
-def parse_detail(session: requests.Session, detail_url: str) -> Dict[str, Optional[str]]:
-    r = safe_get(session, detail_url)
-    result = {"detail_url": detail_url, "titre": None, "organisme": None, "reference": None, "date_publication": None, "date_limite": None, "extrait": None, "statut": "unknown"}
-    if not r:
-        return result
+def conditional_headers(prev: Optional[Dict[str, Optional[str]]]) -> Optional[Dict[str, str]]:
+    if not prev:
+        return None
+    headers = {}
+    if prev.get("etag"):
+        headers["If-None-Match"] = prev["etag"]
+    if prev.get("last_modified"):
+        headers["If-Modified-Since"] = prev["last_modified"]
+    return headers or None
+
+def compute_statut(date_limite: Optional[str]) -> str:
+    if not date_limite:
+        return "published"
+    try:
+        return "open" if date.fromisoformat(date_limite) >= date.today() else "closed"
+    except Exception:
+        return "unknown"
 
-    content_type = (r.headers.get("Content-Type") or "").lower()
-    if "application/pdf" in content_type or detail_url.lower().endswith(".pdf"):
-        result["titre"] = "Document PDF (voir pièce)"
-        result["extrait"] = "PDF détecté — lecture manuelle conseillée."
-        return result
+def _valid_charset(m) -> Optional[str]:
+    # label inconnu ("utf8mb4", "x-user-defined") : ignoré
+    if not m:
+        return None
+    try:
+        codecs.lookup(m.group(1))
+        return m.group(1)
+    except LookupError:
+        return None
+
+def sniff_encoding(content: bytes, content_type: str = "") -> Optional[str]:
+    # charset HTTP en priorité s'il est valide ; sinon UTF-8 s'il décode proprement, sinon la balise <meta>
+    encoding = _valid_charset(_CHARSET_RE.search(content_type))
+    if encoding:
+        return encoding
+    try:
+        content.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    return _valid_charset(_CHARSET_RE.search(content[:4096].decode("latin-1")))
+
+def html_root(content: bytes, content_type: str = "") -> lxml.html.HtmlElement:
+    # encoding=None : défaut libxml2 (latin-1)
+    encoding = sniff_encoding(content, content_type)
+    try:
+        return lxml.html.fromstring(content, parser=lxml.html.HTMLParser(encoding=encoding))
+    except LookupError:
+        # label connu de Python mais pas de libxml2 (ex. "euc_kr") : décodage Python avec remplacement, comme r.text
+        return lxml.html.fromstring(content.decode(encoding, errors="replace"))
 
-    soup = BeautifulSoup(r.text, "html.parser")
-    text = soup.get_text(" ", strip=True)
+def node_text(el) -> str:
+    # nœuds texte séparés par un espace (text_content() les colle : "Date:12/03/2024" casserait les \b des regex)
+    return clean_text(" ".join(el.itertext()))
+
+def extract_fields(root: lxml.html.HtmlElement) -> Dict[str, Optional[str]]:
+    fields = {}
+    # texte visible seulement, comme get_text de BeautifulSoup ; suppression faite en C une fois pour toutes
+    etree.strip_elements(root, "script", "style", with_tail=False)
+    text = node_text(root)
 
     # titre
-    h1 = soup.find("h1")
-    if h1 and h1.get_text(strip=True):
-        result["titre"] = clean_text(h1.get_text(" ", strip=True))
+    h1 = _H1_XP(root)
+    titre = node_text(h1[0]) if h1 else ""
+    if titre:
+        fields["titre"] = titre
     else:
-        meta_og = soup.find("meta", attrs={"property": "og:title"})
-        if meta_og and meta_og.get("content"):
-            result["titre"] = clean_text(meta_og.get("content"))
+        og = _OG_TITLE_XP(root)
+        if og and og[0]:
+            fields["titre"] = clean_text(og[0])
         else:
-            title_tag = soup.find("title")
+            title_tag = _TITLE_XP(root)
             if title_tag:
-                result["titre"] = clean_text(title_tag.get_text())
+                fields["titre"] = clean_text(title_tag[0].text_content())
 
     # organisme
-    for p in [r"Organisme[:\s\-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})",
-              r"Ma[iî]tre d['’ ]ouvrage[:\s\-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})",
-              r"Collectivit[eé][: \-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})",
-              r"Pouvoir adjudicateur[:\s\-]{0,30}([A-ZÀ-Ÿ][A-Za-z0-9 \-&'’]{3,120})"]:
-        m = re.search(p, text, flags=re.IGNORECASE)
+    for pat in _ORG_RES:
+        m = pat.search(text)
         if m:
-            result["organisme"] = clean_text(m.group(1)); break
+            fields["organisme"] = clean_text(m.group(1)); break
 
     # référence
-    mref = re.search(r"(Réf(?:érence)?|Ref\.?|N°|No)\s*[:\-\s]{0,5}([A-Z0-9\-/\.]{3,60})", text, flags=re.IGNORECASE)
+    mref = _REF_RE.search(text)
     if mref:
-        result["reference"] = mref.group(2)
+        fields["reference"] = mref.group(2)
 
     # dates
-    pub, lim = parse_dates_from_text(text)
-    result["date_publication"] = pub
-    result["date_limite"] = lim
+    fields["date_publication"], fields["date_limite"] = parse_dates_from_text(text)
 
     # extrait
-    for p in soup.find_all(["p", "div"]):
-        t = clean_text(p.get_text(" ", strip=True))
+    for el in _BLOCKS_XP(root):
+        t = node_text(el)
         if t and len(t) > 60:
-            result["extrait"] = t[:600]
+            fields["extrait"] = t[:600]
             break
 
+    return fields
+
+def carried_statut(prev: Dict[str, Optional[str]]) -> Optional[str]:
+    # statut d'une fiche non re-parsée : seul un statut issu de la date limite peut évoluer ;
+    # "unknown" (PDF, échec de fetch) est conservé tel quel
+    if prev.get("statut") in ("open", "closed", "published"):
+        return compute_statut(prev.get("date_limite"))
+    return prev.get("statut")
+
+def parse_detail_html(content: bytes, content_type: str = "") -> Dict[str, Optional[str]]:
+    # fonction pure (octets -> champs) pour pouvoir tourner dans un ProcessPoolExecutor.
+    # une page illisible lève une exception : la fiche est journalisée et ignorée, pas réécrite à vide
+    root = html_root(content, content_type)
+    fields = extract_fields(root)
     # statut basique
-    try:
-        if result["date_limite"]:
-            from datetime import date
-            result["statut"] = "open" if date.fromisoformat(result["date_limite"]) >= date.today() else "closed"
-        else:
-            result["statut"] = "published"
-    except Exception:
-        pass
+    fields["statut"] = compute_statut(fields.get("date_limite"))
+    return fields
+
+def parse_detail(
+    session: requests.Session,
+    detail_url: str,
+    prev: Optional[Dict[str, Optional[str]]] = None,
+    parse_pool: Optional[ProcessPoolExecutor] = None,
+) -> Optional[Dict[str, Optional[str]]]:
+    # None : on garde la fiche connue (page inchangée, 304, ou fetch en échec alors qu'une fiche existe déjà)
+    r = safe_get(session, detail_url, headers=conditional_headers(prev))
+    if r is NOT_MODIFIED:
+        return None
+    result = {"detail_url": detail_url, "titre": None, "organisme": None, "reference": None, "date_publication": None, "date_limite": None, "extrait": None, "statut": "unknown", "etag": None, "last_modified": None}
+    if not r:
+        return None if prev else result
+
+    result["etag"] = r.headers.get("ETag")
+    result["last_modified"] = r.headers.get("Last-Modified")
+
+    content_type = (r.headers.get("Content-Type") or "").lower()
+    if "application/pdf" in content_type or is_pdf_url(detail_url) or r.content.startswith(b"%PDF"):
+        result["titre"] = "Document PDF (voir pièce)"
+        result["extrait"] = "PDF détecté — lecture manuelle conseillée."
+        return result
 
+    if parse_pool is None:
+        result.update(parse_detail_html(r.content, content_type))
+    else:
+        # le parsing (CPU) part dans un process ; le thread de fetch attend son résultat
+        result.update(parse_pool.submit(parse_detail_html, r.content, content_type).result())
     return result
 
+def appel_record(
+    url_source_id: str,
+    detail_url: str,
+    detail: Optional[Dict[str, Optional[str]]],
+    prev: Optional[Dict[str, Optional[str]]],
+) -> Optional[Dict[str, Optional[str]]]:
+    # detail=None : page non re-téléchargée (304 ou non échantillonnée), on repart de la fiche connue
+    if detail is None:
+        detail = dict(prev, statut=carried_statut(prev))
+    rec = build_appel(
+        url_source_id=url_source_id,
+        detail_url=detail_url,
+        titre=detail.get("titre") or "(Sans titre)",
+        organisme=detail.get("organisme"),
+        reference=detail.get("reference"),
+        date_publication=detail.get("date_publication"),
+        date_limite=detail.get("date_limite"),
+        statut=detail.get("statut") or "unknown",
+        extrait=detail.get("extrait"),
+        etag=detail.get("etag"),
+        last_modified=detail.get("last_modified"),
+    )
+    # fiche inchangée depuis le dernier run : pas de réécriture
+    if prev and all(prev.get(k) == rec[k] for k in ("content_hash", "reference", "statut", "etag", "last_modified")):
+        return None
+    return rec
+
 # =============== MAIN ===============
 
+def process_source(
+    sb: Client,
+    rest: requests.Session,
+    session: requests.Session,
+    parse_pool: Optional[ProcessPoolExecutor],
+    nom: str,
+    listing_url: str,
+    position: int = 0,
+) -> None:
+    source_id = upsert_url_source(sb, nom=nom, url=listing_url)
+    print(f"[INFO] Source: {nom} | {listing_url} | id={source_id}")
+    cand = find_candidate_links(session, listing_url)
+    print(f"[INFO] {nom}: {len(cand)} liens candidats détectés")
+
+    known = fetch_known_appels(sb, source_id, cand)
+    to_fetch, pending = [], []
+    for u in cand:
+        if u not in known or random.random() < RECHECK_RATIO:
+            to_fetch.append(u)
+            continue
+        # fiche connue non re-téléchargée : réécrite seulement si son statut daté a évolué
+        prev = known[u]
+        if carried_statut(prev) == prev.get("statut"):
+            continue
+        rec = appel_record(source_id, u, None, prev)
+        if rec:
+            pending.append(rec)
+    print(f"[INFO] {nom}: {len(to_fetch)} fiches à télécharger ({len(cand) - len(to_fetch)} déjà connues ignorées)")
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PER_HOST) as pool:
+        futures = {pool.submit(parse_detail, session, u, known.get(u), parse_pool): u for u in to_fetch}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc=f"{nom}", unit="fiche", position=position):
+            u = futures[fut]
+            try:
+                rec = appel_record(source_id, u, fut.result(), known.get(u))
+            except Exception as e:
+                print(f"[ERROR] {u} -> {e}")
+                continue
+            if rec is None:
+                continue
+            pending.append(rec)
+            if len(pending) >= UPSERT_BATCH_SIZE:
+                upsert_appels(rest, pending)
+                pending = []
+    upsert_appels(rest, pending)
+
 def main():
     sb = get_supabase()
-    session = requests.Session()
-
-    for nom, listing_url in START_SOURCES:
-        source_id = upsert_url_source(sb, nom=nom, url=listing_url)
-        print(f"[INFO] Source: {nom} | {listing_url} | id={source_id}")
-        cand = find_candidate_links(session, listing_url)
-        print(f"[INFO] {len(cand)} liens candidats détectés")
-
-        for u in tqdm(cand, desc=f"{nom}", unit="fiche"):
+    rest = get_rest_session()
+    session = make_session()
+
+    # un worker par source : les sites sont sur des hôtes distincts, la politesse est gérée par wait_for_host ;
+    # parsing HTML sur tous les cœurs ("spawn" : pas de fork d'un process déjà multi-threadé)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")) as parse_pool, \
+            ThreadPoolExecutor(max_workers=len(START_SOURCES)) as sources:
+        futures = {
+            sources.submit(process_source, sb, rest, session, parse_pool, nom, listing_url, i): nom
+            for i, (nom, listing_url) in enumerate(START_SOURCES)
+        }
+        for fut in as_completed(futures):
             try:
-                detail = parse_detail(session, u)
-                appel_id = upsert_appel(
-                    sb=sb,
-                    url_source_id=source_id,
-                    detail_url=u,
-                    titre=detail.get("titre") or "(Sans titre)",
-                    organisme=detail.get("organisme"),
-                    reference=detail.get("reference"),
-                    date_publication=detail.get("date_publication"),
-                    date_limite=detail.get("date_limite"),
-                    statut=detail.get("statut") or "unknown",
-                    extrait=detail.get("extrait"),
-                )
+                fut.result()
             except Exception as e:
-                print(f"[ERROR] {u} -> {e}")
-            time.sleep(DELAY_BETWEEN_REQUESTS)
+                print(f"[ERROR] source {futures[fut]} -> {e}")
 
     print("[DONE] Scrape + upsert terminés.")
 
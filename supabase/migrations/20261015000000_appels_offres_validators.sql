@@ -0,0 +1,5 @@
+-- Validateurs HTTP des fiches (requêtes conditionnelles If-None-Match / If-Modified-Since).
+-- À appliquer avant de déployer extract_nc_tenders.py : le script lit et écrit ces colonnes.
+ALTER TABLE appels_offres
+    ADD COLUMN IF NOT EXISTS etag text,
+    ADD COLUMN IF NOT EXISTS last_modified text;